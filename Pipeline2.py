@@ -12,7 +12,7 @@ filepath = "C:/Srirupa/EEG Prepocessing/Clean EEG/clean_data_2.edf"
 output_path = "C:/Srirupa/EEG Prepocessing/Processed EEG/processed_data_1.edf"
 
 # Initiate the preprocessing object
-p = Pipeline(filepath, True)
+p = Pipeline(filepath, True, verbose=True)
 
 # Calling the function filters the data between 0.5 Hz and 55 Hz, resamples to 500 Hz
 # and performs ICA after applying the PREP pipeline to remove bad channels
@@ -1,5 +1,7 @@
-from edf_extraction import slice_edfs
-from multiple_preprocessing import get_processed_data
+import os
+from edf_extraction import slice_edfs_iter
+from individual_func import write_mne_edf
+from preprocessing import Pipeline
 import pandas as pd
 import mne
 import warnings
@@ -7,21 +9,34 @@ warnings.filterwarnings('ignore')
 mne.set_log_level('warning')
 
 source_folder = "C:/Srirupa/EEG Prepocessing/Raw EEG"
-intermediate_folder = "C:/Srirupa/EEG Prepocessing/Clean EEG"
 target_folder = "C:/Srirupa/EEG Prepocessing/Processed EEG"
 
-# Looks for raw EEG files in source folder, and apply the preprocessing(cleaning) to 100 files in total
-# resample to 500 Hz, extract 5 segment of 60 seconds from each EDF file
-# saves new segments as EDF into intermediate folder
-slice_edfs(source_folder=source_folder, target_folder=intermediate_folder, 
-           target_frequency=500, target_length=60, target_segments=5, nfiles=100)
-           
-# if you don't need files limit - don't specify the parameter "nfiles", default is None
+# The two steps can also be run separately with slice_edfs and get_processed_data,
+# which save the clean segments into an intermediate folder and read them back.
+# The guard is needed since those process the files in parallel worker processes,
+# which import this module again on start
+if __name__ == '__main__':
 
+    # Looks for raw EEG files in source folder, and apply the preprocessing(cleaning) to 100 files in total
+    # resample to 500 Hz, extract 5 segment of 60 seconds from each EDF file
+    # if you don't need files limit - don't specify the parameter "nfiles", default is None
+    for scan_id, n, segment in slice_edfs_iter(source_folder=source_folder, target_frequency=500, 
+                                               target_length=60, target_segments=5, nfiles=100):
 
-# Looks for clean EEG files in the intermediate folder, and apply the preprocessing to 100 files in total
-# resample to 500 Hz, filters signal which does not contain bad channels(as per PREP pipeline). 
-# It also performs ICA on the given segment and outputs the ready pre-processed EEG signals in raw format 
-# and saves new segments as EDF into target folder
-get_processed_data(source_folder=intermediate_folder, target_folder=target_folder, 
-            target_frequency=500, n_components=12, nfiles=100)
+        try:
+            # Each clean segment is passed directly in memory to the preprocessing object:
+            # resample to 500 Hz, filters signal which does not contain bad channels(as per PREP pipeline). 
+            # It also performs ICA on the given segment and outputs the ready pre-processed EEG signals in raw format 
+            p = Pipeline(raw=segment)
+            p.applyPipeline(500, 12)
+            raw = p.getRaw()
+
+            # Calling the function drops the bad channels(as per PREP pipeline)
+            raw.drop_channels(raw.info['bads'])
+
+            # Saves the pre-processed segment as EDF into target folder
+            write_mne_edf(raw, fname=os.path.join(target_folder, f"{scan_id}_{n + 1}.edf"), overwrite=True)
+
+        except Exception as err:
+            # any error only skips this segment, the run goes on with the next one
+            print('Preprocessing failed for', scan_id, n + 1, err)
\ No newline at end of file
@@ -1,14 +1,106 @@
 import numpy as np
 import pandas as pd
 import os
+import logging
+import multiprocessing
+import functools
+import inspect
+import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from individual_func import write_mne_edf
 import mne
 from mne.preprocessing import annotate_amplitude
 
+log = logging.getLogger(__name__)
+
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional, without it the kernels run as plain Python
+    def njit(*args, **kwargs):
+        def decorator(func):
+            return func
+        return decorator
+
+# seconds of signal resampled on each side of an extracted segment, see Extractor._crop
+_RESAMPLE_PAD = 5.0
+
+# Raw.resample has method='polyphase' since MNE 1.7, older versions only resample with FFT
+_HAS_POLYPHASE = 'method' in inspect.signature(mne.io.BaseRaw.resample).parameters
+
+
+@functools.lru_cache(maxsize=None)
+def _default_n_jobs():
+    """ Number of jobs used for resampling and filtering when none is given:
+    'cuda' when a CUDA GPU is available (needs CuPy installed), otherwise -1 (all CPU cores).
+    The GPU is probed on the first call, not on import, so the worker
+    processes of slice_edfs and run_batch never touch it.
+    """
+    try:
+        import cupy
+        if cupy.cuda.runtime.getDeviceCount() == 0:
+            return -1
+        # a small FFT on the device, the same kind of work MNE does there
+        cupy.fft.rfft(cupy.ones(64)).get()
+    except Exception:
+        return -1
+
+    # MNE only uses CUDA once it is initialized, even if MNE_USE_CUDA is not set;
+    # init_cuda only warns when it fails, and MNE would then run with a single job
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        mne.cuda.init_cuda(ignore_config=True, verbose='warning')
+    if any(issubclass(w.category, RuntimeWarning) for w in caught):
+        return -1
+    return 'cuda'
+
+
+@njit(cache=True)
+def _plan_segments(bad_starts, bad_ends, tmax, target_length, target_segments):
+    """ Places up to target_segments segments of target_length seconds into 
+    the clean intervals between the bad ones, starting from the first clean interval.
+    
+    Args:
+        bad_starts: float array with starts of the bad intervals, sorted
+        bad_ends: float array with ends of the bad intervals
+        tmax: end of the recording in seconds
+        target_length: length in seconds of each segment
+        target_segments: maximum number of segments
+    Returns:
+        (N, 2) int array with [start, end] timestamps of the segments
+    """
+    segments = np.empty((max(target_segments, 0), 2), dtype=np.int64)
+    found = 0
+    cumulative_end = -np.inf
+    n = bad_starts.shape[0]
+    
+    for i in range(n):
+        # Handle cases when bad intervals overlaps (running maximum of the ends)
+        if bad_ends[i] > cumulative_end:
+            cumulative_end = bad_ends[i]
+        
+        # Define end of the clean interval as a start of next bad interval,
+        # end of edf file for the last one
+        next_start = bad_starts[i + 1] if i + 1 < n else tmax
+        clean_period = next_start - cumulative_end
+        
+        if clean_period > 0:
+            current_start = np.int64(cumulative_end)
+            for k in range(int(clean_period // target_length)):
+                if found >= target_segments:
+                    return segments[:found]
+                segments[found, 0] = np.int64(current_start + k * target_length)
+                segments[found, 1] = np.int64(current_start + k * target_length + target_length)
+                found += 1
+    
+    return segments[:found]
+
 
 def read_edf(filepath):
     '''
     Read an EDF file with MNE package, creates the Raw EDF object. 
+    The signal itself is not loaded, it is read from the file when needed.
     Excludes some channels to keep only target ones.
     Prints warning in case the file doesn't have all 
     neeeded channels, doesn't return object in this case.
@@ -23,7 +115,7 @@ def read_edf(filepath):
         'AUX2', 'AUX3', 'AUX4', 'AUX5', 'AUX6', 'AUX7', 'AUX8', 'Cz', 
         'DC1', 'DC2', 'DC3', 'DC4', 'DIF1', 'DIF2', 'DIF3', 'DIF4', 
         'Fp1', 'Fp2', 'Fpz', 'Fz', 'PG1', 'PG2', 'Patient Event', 'Photic', 
-        'Pz', 'Trigger Event', 'X1', 'X2', 'aux1', 'phoic', 'photic'], verbose='warning', preload=True)
+        'Pz', 'Trigger Event', 'X1', 'X2', 'aux1', 'phoic', 'photic'], verbose='warning', preload=False)
     
     if 'EKG1' in data.ch_names and 'EOG1' in data.ch_names:
         data.set_channel_types({'EOG1': 'eog', 'EOG2': 'eog', 'EKG1': 'ecg', 'EKG2': 'ecg'})
@@ -42,10 +134,11 @@ class Extractor:
 
     The class instantiates a preprocessing object which 
     carries a Raw EDF file through a sequence of operations: 
-    (1) resample each recording's signal to traget frequency
-    (2) identifies timestamps of hyperventilation (HV), photic stimulation (PhS)
+    (1) identifies timestamps of hyperventilation (HV), photic stimulation (PhS)
     and flat (zero) signal (together - "bad" intervals)
-    (3) extract EEG segment(s) of needed length from "good" intervals
+    (2) extract EEG segment(s) of needed length from "good" intervals
+    (3) resample each segment's signal to traget frequency; only the
+    segments are loaded into memory, not the whole recording
     Then the object can save extracted segment(s) into new EDF files 
     OR return a Pandas DataFrame with data
 
@@ -54,10 +147,10 @@ class Extractor:
         target_frequency: interger indicating the final EEG frequency after resampling
         raw: MNE Raw EDF object
         sfreq: initial sampling frequency of EEG
-        bad_intervals: list of lists of the form [start, end] with timemstamps in seconds,
-            indicating starts and ends of bad interval (HV, PhS, flat signal)
-        clean_intervals: list of lists of the form [start, end] with timemstamps in seconds,
-            indicating starts and ends of segments to be extracted
+        bad_intervals: (N, 2) float array, each row of the form [start, end] with timemstamps 
+            in seconds, indicating starts and ends of bad interval (HV, PhS, flat signal)
+        clean_intervals: (N, 2) int array, each row of the form [start, end] with timemstamps 
+            in seconds, indicating starts and ends of segments to be extracted
             
     Methods:
         flat_intervals: returns list of [start, end] timestamps in seconds of zero signal
@@ -65,42 +158,59 @@ class Extractor:
         photic_stimulation: returns list of [start, end] timestamps in seconds of PhS
         extract_good: calling this method defines clean_intervals; 
             it doens't manipulate data itsef, just returns the intervals' timestamps
+        segments: yields the segments defined by clean_intervals as MNE Raw objects
         save_edf: write new EDF files based on clean_intervals timestamps
+        extract_and_save: extract_good followed by save_edf in one call
     """
     
-    def __init__(self, filepath, target_frequency):
+    def __init__(self, filepath, target_frequency, n_jobs=None):
         """
         Args:
             filepath: str with path to EDF file
             target_frequency: interger indicating the final EEG frequency after resampling
+            n_jobs: number of jobs (or 'cuda') used for resampling; 
+                by default the GPU if available, else all CPU cores
             lfreq: lower frequency boundary of the signal to keep
             hfreq: higher frequency boundary of the signal to keep
         """
         self.filename = filepath
         self.target_frequency = target_frequency
+        self.n_jobs = _default_n_jobs() if n_jobs is None else n_jobs
         self.raw = read_edf(filepath)
+        if self.raw is None:
+            raise ValueError("Don't have needed channels")
         self.sfreq = dict(self.raw.info)['sfreq']
-        if(self.sfreq != self.target_frequency):
-            self.raw.resample(self.target_frequency)
         
-        self.clean_intervals = []
+        # annotations arrays shared by hyperventilation and photic_stimulation;
+        # they are read once here, so annotations must not be modified afterwards
+        ann = self.raw.annotations
+        # fixed-width str array built from Python strings; newer MNE stores the descriptions
+        # as numpy StringDType, which can't be cast with astype(str)
+        self._descs = np.array([str(d) for d in ann.description], dtype=str)
+        self._onsets = np.asarray(ann.onset, dtype=np.float64)
+        self._durs = np.asarray(ann.duration, dtype=np.float64)
+        
+        self.clean_intervals = np.empty((0, 2), dtype=np.int64)
+        self._flat_cache = None
         self.intervals_df = pd.DataFrame()
         mne.set_log_level('warning')
         
 
     def flat_intervals(self):
-        '''Identify beginning and end times of flat signal
+        '''Identify beginning and end times of flat signal.
+        The result is kept, so repeated calls of extract_good don't scan the signal again
         
         Returns:
             list of floats, contains start and end times
         '''
+        if self._flat_cache is not None:
+            return self._flat_cache
+        
         annot_bad_seg, flat_chan = annotate_amplitude(self.raw, bad_percent=50.0, min_duration=10, flat=1e-06, picks=None, verbose=None)
-        intervals = []
-        for i in annot_bad_seg:
-            start = list(i.items())[0][1]
-            duration = list(i.items())[1][1]
-            end = start+duration
-            intervals.append([start,end])
+        onsets = np.asarray(annot_bad_seg.onset)
+        durations = np.asarray(annot_bad_seg.duration)
+        intervals = np.column_stack([onsets, onsets + durations]).tolist()
+        self._flat_cache = intervals
         return intervals
 
 
@@ -114,25 +224,28 @@ class Extractor:
         start = np.nan
         end = np.nan
 
-        for position, item in enumerate(self.raw.annotations.description):
-            if item in ["HV 1Min", "HV 1 Min"]:
-                start = self.raw.annotations.onset[position] - 90
-            if item in ["Post HV 30 Sec", "Post HV 60 Sec", "Post HV 90 Sec"]:
-                end = self.raw.annotations.onset[position] + (90 - int(item.split(' ')[2]))
+        descs = self._descs
+        onsets = self._onsets
+
+        # positions of the marks, the last one wins when repeated
+        hv_start = np.flatnonzero(np.isin(descs, ["HV 1Min", "HV 1 Min"]))
+        hv_end = np.flatnonzero(np.isin(descs, ["Post HV 30 Sec", "Post HV 60 Sec", "Post HV 90 Sec"]))
+        hv_begin = np.flatnonzero(np.isin(descs, ["HV Begin", "Begin HV"]))
+        hv_stop = np.flatnonzero(np.isin(descs, ["HV End", "End HV"]))
 
-        if np.isnan(start):
-            for position, item in enumerate(self.raw.annotations.description):
-                if item in ["HV Begin", "Begin HV"]:
-                    start = self.raw.annotations.onset[position] - 30
+        if hv_start.size:
+            start = onsets[hv_start[-1]] - 90
+        elif hv_begin.size:
+            start = onsets[hv_begin[-1]] - 30
 
-        if np.isnan(end):
-            for position, item in enumerate(self.raw.annotations.description):
-                if item in ["HV End", "End HV"]:
-                    end = self.raw.annotations.onset[position] + 90
+        if hv_end.size:
+            end = onsets[hv_end[-1]] + (90 - int(descs[hv_end[-1]].split(' ')[2]))
+        elif hv_stop.size:
+            end = onsets[hv_stop[-1]] + 90
 
         # when hyperventilation is present
         # eliminate the corresponding segment
-        if start != np.nan and end != np.nan:
+        if not np.isnan(start) and not np.isnan(end):
             return [[start, end]]
         else:
             return []
@@ -144,27 +257,19 @@ class Extractor:
             list of floats, contains start and end times
         """
         
-        # store times when stimulation occurs
-        stimulation = []
-        
-        # loop over descriptions and identify those that contain frequencies
-        for position, annot in enumerate(self.raw.annotations.description):
-            if "Hz" in annot:
-                # record the positions of stimulations
-                stimulation.append(position)
+        # record the positions of descriptions that contain frequencies
+        stimulation = np.flatnonzero(np.char.find(self._descs, "Hz") >= 0)
         
         # provided stimulation has occured
-        if len(stimulation)>1:
+        if stimulation.size > 1:
             
             # identify beginning and end
-            start = self.raw.annotations.onset[stimulation[0]]
-            end = self.raw.annotations.onset[stimulation[-1]] + self.raw.annotations.duration[stimulation[-1]]
+            start = self._onsets[stimulation[0]]
+            end = self._onsets[stimulation[-1]] + self._durs[stimulation[-1]]
             return [[start, end]]    
         else:
+            # no stimulation is present
             return []
-        
-        # null value when no stimulation is present
-        return None
 
 
     def extract_good(self, target_length, target_segments):
@@ -179,83 +284,89 @@ class Extractor:
                 
         """
         
-        self.bad_intervals = []
+        bad = []
         # calling functions to identify different kinds of "bad" intervals
-        self.bad_intervals.extend(self.flat_intervals())
-        self.bad_intervals.extend(self.hyperventilation())
-        self.bad_intervals.extend(self.photic_stimulation())
-        self.bad_intervals.sort()
+        bad.extend(self.flat_intervals())
+        bad.extend(self.hyperventilation())
+        bad.extend(self.photic_stimulation())
+        
+        # sort by starts; stable, so intervals with equal starts keep their order
+        bad = np.asarray(bad, dtype=np.float64).reshape(-1, 2)
+        bad = bad[np.argsort(bad[:, 0], kind='stable')]
         
-        self.clean_part = self.raw.copy()
-        tmax = len(self.raw)/self.target_frequency
+        tmax = len(self.raw)/self.sfreq
                 
         # Add 'empty' bad intervals in the begging and in the end for furhter consistency
-        self.bad_intervals.insert(0,[0, 420]) # <--- TAKE FIRST SEVEN MINUTES AS BAD BY DEFAULT
-        self.bad_intervals.append([tmax, tmax])
-        # Construct temporary dataframe to find clean interval in EDF
-        tmp_df = pd.DataFrame(self.bad_intervals, columns=['start', 'end'])
+        # <--- TAKE FIRST SEVEN MINUTES AS BAD BY DEFAULT
+        self.bad_intervals = np.vstack([[0, 420], bad, [tmax, tmax]])
+        bad = self.bad_intervals
         
-        # Define end of the clean interval as a start of next bad interval
-        tmp_df['next_start'] = tmp_df['start'].shift(periods=-1)
-        tmp_df.iloc[-1,-1] = tmax # <= Assign end of edf file as the end of last clean interval
+        # if we need 5 segments, and the recording has more, it extracts 5; 
+        # if the recording has less than 5, let's say only 3 segments, it extracts 3
+        # clean_intervals keeps the timestamps starting from the first available intervals
+        self.clean_intervals = _plan_segments(bad[:, 0], bad[:, 1], float(tmax), 
+                                              target_length, int(target_segments))
         
-        # Handle cases when bad intervals overlaps
-        prev_value = 0
-        new_ends = []
-        for value in tmp_df['end']:
-            if prev_value > value :
-                new_ends.append(prev_value)
+        # whether there is at least 1 clean interval with needed target length
+        self.resolution = len(self.clean_intervals) > 0
+            
+    def _resample(self, raw, n_jobs=None):
+        """ Resamples the given (loaded) Raw object to target_frequency in place,
+        with n_jobs jobs (self.n_jobs by default)
+        """
+        n_jobs = self.n_jobs if n_jobs is None else n_jobs
+
+        # EDF sampling rates may differ from the target only by rounding, no resampling then
+        if abs(self.sfreq - self.target_frequency) > 1e-3:
+            if (_HAS_POLYPHASE and self.sfreq > self.target_frequency 
+                    and (self.sfreq / self.target_frequency).is_integer()):
+                # integer downsampling: polyphase filtering (low-pass + decimation)
+                # is much cheaper than the FFT resampling (and runs on the CPU only)
+                raw.resample(self.target_frequency, method='polyphase', 
+                             n_jobs=1 if n_jobs == 'cuda' else n_jobs)
             else:
-                new_ends.append(value)
-                prev_value = value
-        tmp_df['cumulative_end'] = new_ends
+                raw.resample(self.target_frequency, npad='auto', n_jobs=n_jobs)
+
+    def _crop(self, interval_start, interval_end, n_jobs=None):
+        """ Returns a copy of the recording cropped to [interval_start, interval_end)
+        and resampled to target_frequency with n_jobs jobs (self.n_jobs by default). 
+        Only this window, plus a margin of _RESAMPLE_PAD seconds on each side, is read from the file.
+        """
+        # the margin is resampled too and cut off afterwards, so the resampling edge
+        # effects stay outside the window, as when the whole recording was resampled
+        tmin = max(interval_start - _RESAMPLE_PAD, 0)
+        tmax = min(interval_end + _RESAMPLE_PAD, self.raw.times[-1])
+        segment = self.raw.copy().crop(tmin, tmax)
+        segment.load_data()
+        self._resample(segment, n_jobs=n_jobs)
+        segment.crop(interval_start - tmin, interval_end - tmin, include_tmax=False)
+        return segment
+
+    def segments(self):
+        """ The function yields the segments defined by clean_intervals timestamps,
+        one at a time, as MNE Raw objects.
         
-        # Calculate lengths of clean intervals
-        tmp_df['clean_periods'] = tmp_df['next_start'] - tmp_df['cumulative_end']
+        Yields:
+            tuple (n, raw) with the index of the segment and the segment itself
+        """
+        for n, (interval_start, interval_end) in enumerate(self.clean_intervals):
+            # the copy is kept only for the current segment
+            yield n, self._crop(interval_start, interval_end)
+
+    def _write_one(self, job):
+        """ Crops one segment and writes it into an EDF file, used by save_edf
         
-        # Check whether there is at least 1 clean interval with needed target length
-        if tmp_df[tmp_df['clean_periods'] >= target_length].shape[0] == 0:
-            self.resolution = False
-            pass
-        else:    
-            # if there is at least one clean segment of needed length, it updates clean_intervals list
-            self.resolution = True
-            
-            # check how many availabe segments of needed length the whole recording has
-            total_available_segments = (tmp_df[tmp_df['clean_periods'] > 0]['clean_periods'] // target_length).sum()
-            
-            # if we need 5 segments, and the recording has more, it extracts 5; 
-            # if the recording has less than 5, let's say only 3 segments, it extracts 3
-            if target_segments < total_available_segments:
-                n_samples = target_segments
-            else:
-                n_samples = total_available_segments
-                
-            starts = list(tmp_df[tmp_df['clean_periods'] > 0]['cumulative_end'])
-            n_available_segments = list(tmp_df[tmp_df['clean_periods'] > 0]['clean_periods'] // target_length)
-            
-            # updates clean_intervals attribute with timestamps
-            # starting from the first available intervals
-            for i in range(len(n_available_segments)):
-                current_start = int(starts[i])
-                for s in range(int(n_available_segments[i])):
-                    self.clean_intervals.append(
-                    (
-                        int(current_start), 
-                        int(current_start + target_length)
-                    )
-                    )
-                    #print(s, self.clean_intervals)
-                    current_start += target_length
-                    if len(self.clean_intervals) >= n_samples:
-                        break
-                if len(self.clean_intervals) >= n_samples:
-                    break
-            
+        Args:
+            job - tuple (interval_start, interval_end, out_path)
+        """
+        interval_start, interval_end, out_path = job
+        # a single job, so the threads of save_edf don't each start their own pool
+        write_mne_edf(self._crop(interval_start, interval_end, n_jobs=1), fname=out_path, overwrite=True)
+
     def save_edf(self, folder, filename):
         """ The function write out new EDF file(s) based on clean_intervals timestamps.
         It save each segment into separate EDF file, with suffixes "[scan_id]_1",
-        "[scan_id]_2", etc. 
+        "[scan_id]_2", etc. Up to 4 segments are written at the same time.
         
         Args:
             folder - where to save new EDF files
@@ -263,29 +374,138 @@ class Extractor:
         """
         
         # check if there are available clean segments
-        if self.resolution:
-            for n in range(len(self.clean_intervals)):
-                interval_start = self.clean_intervals[n][0]
-                interval_end = self.clean_intervals[n][1]
-                
-                tmp_raw_edf = self.clean_part.copy()
-                
-                tmp_raw_edf.crop(interval_start, interval_end, include_tmax=False)
-                
-                if n >= 0:
-                    scan_id = filename.split('.')[0]
-                    write_mne_edf(tmp_raw_edf, fname=folder+'/'+scan_id + '_' + str(n + 1)+'.edf', overwrite=True)
-                # else:
-                #     write_mne_edf(tmp_raw_edf, fname=folder+'/'+filename, overwrite=True)
+        if self.resolution and len(self.clean_intervals) > 0:
+            scan_id = os.path.splitext(filename)[0]
+            jobs = [(interval_start, interval_end, os.path.join(folder, f"{scan_id}_{n + 1}.edf"))
+                    for n, (interval_start, interval_end) in enumerate(self.clean_intervals)]
+            
+            # the segments are independent, so reading, resampling and writing
+            # of one segment can overlap with the others
+            with ThreadPoolExecutor(max_workers=max(1, min(4, len(jobs)))) as tp:
+                list(tp.map(self._write_one, jobs))
         else:
             print('No clean intervals of needed length')
+
+    def extract_and_save(self, folder, filename, target_length, target_segments):
+        """ The function defines clean_intervals and writes the segments out right away.
+        Each segment is read from the file, resampled and written on its own, 
+        so the whole recording is never held in memory.
+        
+        Args:
+            folder - where to save new EDF files
+            filename - main name for output files (suffix will be added for more > 1 files)
+            target_length: length in seconds of the each 
+                segments to extract from this EEG recording
+            target_segments: number of segments to extract 
+                from this EEG recording
+        """
+        self.extract_good(target_length=target_length, target_segments=target_segments)
+        self.save_edf(folder=folder, filename=filename)
             
             
+def _process_one_extract(path, target_folder, target_frequency, target_length, target_segments):
+    """ Extracts clean segment(s) from a single EDF file. Kept at module level
+    so it can be pickled and sent to the worker processes of slice_edfs.
+    
+    Args:
+        path: str with path to EDF file
+        target_folder: folder where to save extractd segments in EDF formats
+        target_frequency: interger indicating the final EEG frequency after resampling
+        target_length: length of each of the extracted segments (in seconds)
+        target_segments: number of segments to extract from the EDF file
+    Returns:
+        True if the extraction succeeded, False otherwise; 
+        unexpected errors are raised (and logged by _run_pool)
+    """
+    try:
+        # the files are already spread over the cores, so each worker resamples
+        # with a single job on the CPU; one GPU shared by all workers would run out of memory
+        e = Extractor(path, target_frequency=target_frequency, n_jobs=1)
+
+        # This calls internal functions to detect 'bad intervals', define the 'good' ones
+        # and save them as new EDF files to output_folder. In case there are more than 1, it adds suffix "_n" to the file name 
+        e.extract_and_save(folder=target_folder, filename=os.path.basename(path), 
+                           target_length=target_length, target_segments=target_segments)
+
+        return True
+
+    except (OSError, ValueError, RuntimeError) as err:
+        log.warning('Extraction failed for %s: %s', path, err)
+        return False
+
+
+def _list_edfs(source_folder, nfiles=None):
+    """ Lists the EDF files in source_folder, sorted by path, so the same files 
+    are picked on every run when nfiles is set
+    
+    Args:
+        source_folder: folder path with EDF files
+        nfiles: limit number of files (default=None, no limit)
+    Returns:
+        list of paths of the EDF files
+    """
+    with os.scandir(source_folder) as it:
+        paths = sorted(e.path for e in it if e.is_file() and e.name.lower().endswith('.edf'))
+    return paths[:nfiles]
+
+
+def _run_pool(worker, paths, *args, n_workers=None):
+    """ Runs worker(path, *args) for every path in parallel worker processes,
+    used by slice_edfs and multiple_preprocessing.run_batch. 
+    The worker returns True if the file succeeded, False otherwise. Any other error 
+    raised by the worker is logged and the file counted as failed, the other files go on.
+    
+    Args:
+        worker: picklable function taking a path (and the matching items of args)
+        paths: list of paths of the files to process
+        args: more lists with one item per path, passed to worker after the path
+        n_workers: number of worker processes (default=None, one per CPU core)
+    Returns:
+        list of paths of the files that failed, so they can be retried
+    """
+    # one BLAS thread per worker, otherwise the workers oversubscribe the cores;
+    # the workers copy the environment on start, so it is restored afterwards
+    omp_threads = os.environ.get("OMP_NUM_THREADS")
+    os.environ["OMP_NUM_THREADS"] = "1"
+
+    i = 0
+    failures = []
+
+    try:
+        # "spawn" gives every worker its own fresh MNE state and thread pools
+        with ProcessPoolExecutor(max_workers=n_workers or os.cpu_count(), 
+                                 mp_context=multiprocessing.get_context("spawn")) as ex:
+            futures = [ex.submit(worker, path, *items) for path, *items in zip(paths, *args)]
+            for path, future in zip(paths, futures):
+                try:
+                    ok = future.result()
+                except Exception:
+                    log.exception('Processing failed for %s', path)
+                    ok = False
+
+                if not ok:
+                    failures.append(path)
+                    continue
+
+                i += 1
+
+                if i % 100 == 0:
+                    print(i, 'EDF saved')
+    finally:
+        if omp_threads is None:
+            del os.environ["OMP_NUM_THREADS"]
+        else:
+            os.environ["OMP_NUM_THREADS"] = omp_threads
+
+    return failures
+
+
 def slice_edfs(source_folder, target_folder, target_frequency, 
                target_length, target_segments=1, nfiles=None):
     """ The function run a pipeline for extracting clean segment(s) of needed length 
     from multiple EDF files. It takes preprocessing parameters, look up for the files 
     in source folder, and perform preprocessing and extraction, if found.
+    Files are processed in parallel, one worker process per CPU core.
     
     Args:
         source_folder: folder path with EDF files 
@@ -295,34 +515,63 @@ def slice_edfs(source_folder, target_folder, target_frequency,
         target_segments: number of segments to extract from each EDF file;
             will extract less if less available (default=0.5)
         nfiles: limit number of files to preprocess and extract segments (default=None, no limit)
+    Returns:
+        list of paths of the files that failed, so they can be retried
     
     """
    
-    existing_edf_names = os.listdir(source_folder)
+    paths = _list_edfs(source_folder, nfiles)
 
-    i = 0
+    worker = partial(_process_one_extract, target_folder=target_folder, 
+                     target_frequency=target_frequency, target_length=target_length, 
+                     target_segments=target_segments)
+
+    return _run_pool(worker, paths)
 
-    for file in existing_edf_names:
 
-        path = source_folder + '/' + file
+def slice_edfs_iter(source_folder, target_frequency, target_length, 
+                    target_segments=1, nfiles=None, target_folder=None):
+    """ The function runs the same extraction as slice_edfs, but yields the extracted 
+    segment(s) as MNE Raw objects, so the later preprocessing can use them directly 
+    instead of reading them back from EDF files. Files are processed one after another,
+    in the calling process; use slice_edfs to process them in parallel.
+    
+    Args:
+        source_folder: folder path with EDF files 
+        target_frequency: interger indicating the final EEG frequency after resampling
+        target_length: length of each of the extracted segments (in seconds)
+        target_segments: number of segments to extract from each EDF file;
+            will extract less if less available (default=1)
+        nfiles: limit number of files to preprocess and extract segments (default=None, no limit)
+        target_folder: if given, the segments are also saved there in EDF format
+            (default=None, nothing is written)
+    Yields:
+        tuple (scan_id, n, raw) with the name of the source file without extension,
+        the index of the segment and the segment as MNE Raw object
+    """
+   
+    for path in _list_edfs(source_folder, nfiles):
 
         try:
-            # Initiate the preprocessing object, resample and filter the data
             e = Extractor(path, target_frequency=target_frequency)
-
-            # This calls internal functions to detect 'bad intervals' and define 5 'good' ones 60 seconds each
             e.extract_good(target_length=target_length, target_segments=target_segments)
 
-            # Calling the function saves new EDF files to output_folder. In case there are more than 1, it adds suffix "_n" to the file name 
-            e.save_edf(folder=target_folder, filename=file)
+        except Exception:
+            log.exception('Extraction failed for %s', path)
+            continue
 
-            i += 1
+        scan_id = os.path.splitext(os.path.basename(path))[0]
 
-        except:
-            print('Extraction failed')
+        # the segments are read from the file and resampled only here, so a broken
+        # segment can also fail at this point; it is skipped and the next one is tried
+        for n, (interval_start, interval_end) in enumerate(e.clean_intervals):
+            try:
+                segment = e._crop(interval_start, interval_end)
+                if target_folder is not None:
+                    write_mne_edf(segment, fname=os.path.join(target_folder, f"{scan_id}_{n + 1}.edf"), overwrite=True)
 
-        if i % 100 == 0 and i != 0:
-            print(i, 'EDF saved')
+            except Exception:
+                log.exception('Extraction failed for segment %d of %s', n + 1, path)
+                continue
 
-        if i == nfiles:
-            break
\ No newline at end of file
+            yield scan_id, n, segment
@@ -1,59 +1,101 @@
 import numpy as np
 import pandas as pd
 import os
+import logging
+from functools import partial
 from individual_func import write_mne_edf
 import mne
 from mne.preprocessing import annotate_amplitude
 from individual_func import write_mne_edf
 from preprocessing import Pipeline
+from edf_extraction import _list_edfs, _run_pool
 
-def get_processed_data(source_folder, target_folder, target_frequency, n_components, nfiles=None):
-    """ The function run a pipeline for applying the preprocessing steps, namely, filrering,
-    re-sampling, removing bad chaanels and performing ICA on multiple EDF files. It takes preprocessing 
-    parameters, look up for the files in source folder, and perform preprocessing if found.
+log = logging.getLogger(__name__)
+
+def _process_one_pipeline(path, out_path, target_frequency, n_components, cache=False):
+    """ Applies the preprocessing pipeline to a single EDF file. Kept at module level
+    so it can be pickled and sent to the worker processes of run_batch.
     
     Args:
-        source_folder: folder path with clean extractd segments of EDF files 
-        target_folder: folder where to save pre-proceesed in EDF formats
+        path: str with path to the clean EDF segment
+        out_path: str with path of the pre-processed EDF file to write
         target_frequency: interger indicating the final EEG frequency after resampling
         n_components: number of components using which we will perform the ICA
-        nfiles: limit number of files to preprocess and extract segments (default=None, no limit)
-    
+        cache: boolean value to denote if the file is read through the NumPy cache of Pipeline
+    Returns:
+        True if the preprocessing succeeded, False otherwise; 
+        unexpected errors are raised (and logged by edf_extraction._run_pool)
     """
-   
-    existing_edf_names = os.listdir(source_folder)
+    try:
 
-    i = 0
+        # Initiate the preprocessing object, plots are never shown in the workers;
+        # the files are already spread over the cores, so each worker resamples and 
+        # filters with a single job on the CPU; one GPU shared by all workers would run out of memory
+        p = Pipeline(path, view_plots=False, n_jobs=1, cache=cache)
 
-    for file in existing_edf_names:
+        # Calling the function filters the data between 0.5 Hz and 55 Hz, resamples to 500 Hz
+        # and performs ICA after applying the PREP pipeline to remove bad channels
+        p.applyPipeline(target_frequency, n_components)
 
-        path = source_folder + '/' + file
+        # Calling the function gets the pre-processed data in raw format
+        raw = p.getRaw()
 
-        try:
+        # Calling the function drops the bad channels(as per PREP pipeline)
+        raw.drop_channels(raw.info['bads'])
 
-            # Initiate the preprocessing object
-            p = Pipeline(path)
+        # Calling the function saves pre-processed EDF files to output_folder.
+        write_mne_edf(raw, fname=out_path, overwrite=True)
 
-            # Calling the function filters the data between 0.5 Hz and 55 Hz, resamples to 500 Hz
-            # and performs ICA after applying the PREP pipeline to remove bad channels
-            p.applyPipeline(target_frequency, n_components)
+        return True
 
-            # Calling the function gets the pre-processed data in raw format
-            raw = p.getRaw()
+    except (OSError, ValueError, RuntimeError) as e:
+        log.warning('Preprocessing failed for %s: %s', path, e)
+        return False
 
-            # Calling the function drops the bad channels(as per PREP pipeline)
-            raw.drop_channels(raw.info['bads'])
 
-            # Calling the function saves pre-processed EDF files to output_folder.
-            write_mne_edf(raw, fname=target_folder + '/processed_data_' + str(i + 1) + '.edf', overwrite=True)
+def run_batch(file_list, target_folder, target_frequency, components, n_workers=None, cache=False):
+    """ The function applies the preprocessing pipeline to the given EDF files in parallel,
+    each file in its own worker process, and saves the results into target folder
+    as "processed_data_1.edf", "processed_data_2.edf", etc. in the order of file_list.
+    
+    Args:
+        file_list: list of paths to EDF files
+        target_folder: folder where to save pre-proceesed in EDF formats
+        target_frequency: interger indicating the final EEG frequency after resampling
+        components: number of components using which we will perform the ICA
+        n_workers: number of worker processes (default=None, one per CPU core)
+        cache: read the files through a NumPy cache kept next to them, which makes
+            repeated runs on the same files faster (default=False)
+    Returns:
+        list of paths of the files that failed, so they can be retried
+    """
+    out_paths = [os.path.join(target_folder, f"processed_data_{n + 1}.edf") for n in range(len(file_list))]
+
+    worker = partial(_process_one_pipeline, target_frequency=target_frequency, 
+                     n_components=components, cache=cache)
 
-            i += 1
+    return _run_pool(worker, file_list, out_paths, n_workers=n_workers)
 
-        except:
-            print('Preprocessing failed')
 
-        if i % 100 == 0 and i != 0:
-            print(i, 'EDF saved')
+def get_processed_data(source_folder, target_folder, target_frequency, n_components, nfiles=None, cache=False):
+    """ The function run a pipeline for applying the preprocessing steps, namely, filrering,
+    re-sampling, removing bad chaanels and performing ICA on multiple EDF files. It takes preprocessing 
+    parameters, look up for the files in source folder, and perform preprocessing if found.
+    Files are processed in parallel, one worker process per CPU core.
+    
+    Args:
+        source_folder: folder path with clean extractd segments of EDF files 
+        target_folder: folder where to save pre-proceesed in EDF formats
+        target_frequency: interger indicating the final EEG frequency after resampling
+        n_components: number of components using which we will perform the ICA
+        nfiles: limit number of files to preprocess and extract segments (default=None, no limit)
+        cache: read the files through a NumPy cache kept next to them, which makes
+            repeated runs on the same files faster (default=False)
+    Returns:
+        list of paths of the files that failed, so they can be retried
+    
+    """
+   
+    paths = _list_edfs(source_folder, nfiles)
 
-        if i == nfiles:
-            break
\ No newline at end of file
+    return run_batch(paths, target_folder, target_frequency, n_components, cache=cache)
@@ -1,11 +1,249 @@
 import mne
 import numpy as np
 import os
-import matplotlib.pyplot as plt
+import pickle
+import tempfile
+import functools
+import contextlib
+import logging
+from unittest import mock
 from mne import viz
+import pyprep.ransac
 from pyprep.prep_pipeline import PrepPipeline
-from mne.preprocessing import (ICA, create_eog_epochs, create_ecg_epochs,
-                               corrmap)
+from mne.preprocessing import ICA
+# private MNE helper, the z-score outlier test used by find_bads_eog/find_bads_ecg
+from mne.preprocessing.bads import _find_outliers
+from edf_extraction import _default_n_jobs, njit
+
+log = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def _standard_montage(kind):
+    """Builds the standard montage of the given kind once per process, 
+    it is the same for every file
+
+    Args:
+        kind: str with the name of the montage, e.g. "standard_1005"
+
+    Returns:
+        MNE DigMontage object
+    """
+    return mne.channels.make_standard_montage(kind)
+
+
+@functools.lru_cache(maxsize=None)
+def _line_freqs(sample_rate):
+    """Line noise frequencies (60 Hz and harmonics) below Nyquist frequency,
+    computed once per sample rate
+
+    Args:
+        sample_rate: sampling frequency of the EEG
+
+    Returns:
+        array of frequencies
+    """
+    return np.arange(60, sample_rate / 2, 60)
+
+
+_mne_interpolation_matrix = getattr(pyprep.ransac, "_make_interpolation_matrix", None)
+
+
+@functools.lru_cache(maxsize=512)
+def _cached_interpolation_matrix(from_bytes, to_bytes, n_from, n_to):
+    """Spherical spline interpolation matrix between two sets of channel positions,
+    computed once per process for each set of positions
+
+    Args:
+        from_bytes: bytes of the (n_from, 3) float64 positions of the predicting channels
+        to_bytes: bytes of the (n_to, 3) float64 positions of the predicted channels
+        n_from: number of predicting channels
+        n_to: number of predicted channels
+
+    Returns:
+        read-only (n_to, n_from) array
+    """
+    pos_from = np.frombuffer(from_bytes).reshape(n_from, 3)
+    pos_to = np.frombuffer(to_bytes).reshape(n_to, 3)
+    mat = _mne_interpolation_matrix(pos_from, pos_to)
+    mat.flags.writeable = False
+    return mat
+
+
+def _make_interpolation_matrix(pos_from, pos_to, *args, **kwargs):
+    """Drop-in for the interpolation matrix function used by PREP's RANSAC, 
+    which reuses the matrices of earlier segments with the same montage and channels
+    """
+    if args or kwargs:
+        return _mne_interpolation_matrix(pos_from, pos_to, *args, **kwargs)
+    pos_from = np.ascontiguousarray(pos_from, dtype=np.float64)
+    pos_to = np.ascontiguousarray(pos_to, dtype=np.float64)
+    return _cached_interpolation_matrix(pos_from.tobytes(), pos_to.tobytes(),
+                                        len(pos_from), len(pos_to))
+
+
+def _cached_ransac():
+    """Context in which PREP's RANSAC takes its interpolation matrices from the cache.
+    RANSAC builds one matrix per random channel subset, for every segment, while they
+    only depend on the channel positions. pyprep is patched only inside the context.
+
+    Returns:
+        context manager
+    """
+    if _mne_interpolation_matrix is None:
+        _warn_no_ransac_cache()
+        return contextlib.nullcontext()
+    return mock.patch.object(pyprep.ransac, "_make_interpolation_matrix", _make_interpolation_matrix)
+
+
+@functools.lru_cache(maxsize=None)
+def _warn_no_ransac_cache():
+    """Logs once per process that the RANSAC cache can't be used with this pyprep version"""
+    log.warning("pyprep.ransac has no _make_interpolation_matrix, "
+                "RANSAC interpolation matrices are not cached")
+
+
+@njit(fastmath=True, cache=True)
+def _corr_rows(X, y):
+    """Pearson correlation of every row of X with y
+
+    Args:
+        X: (k, n) float array, e.g. ICA sources
+        y: (n,) float array, e.g. EOG or ECG channel
+
+    Returns:
+        (k,) float array of correlations
+    """
+    k, n = X.shape
+    out = np.empty(k)
+    yc = y - y.mean()
+    yn = np.sqrt((yc * yc).sum())
+    for i in range(k):
+        xc = X[i] - X[i].mean()
+        out[i] = (xc * yc).sum() / (np.sqrt((xc * xc).sum()) * yn + 1e-12)
+    return out
+
+
+def _pearson_rows(sources, target):
+    """Score function for ICA.score_sources, same as its "pearsonr" but
+    computed for all sources at once with _corr_rows"""
+    return _corr_rows(np.ascontiguousarray(sources, dtype=np.float64),
+                      np.ascontiguousarray(target, dtype=np.float64).ravel())
+
+
+def _find_bads_corr(ica, raw, ch_names, l_freq, h_freq, threshold=3.0):
+    """Finds the ICA components correlated with the given channels, the way 
+    ICA.find_bads_eog and ICA.find_bads_ecg(method='correlation') do it:
+    z-scored correlations above threshold are bad, ordered by absolute score.
+    It depends on MNE's private _find_outliers and copies the logic of those
+    methods, so it has to be checked against them when MNE is upgraded.
+
+    Args:
+        ica: fitted ICA object
+        raw: the EEG segment in raw format
+        ch_names: list of names of the reference (EOG or ECG) channels
+        l_freq: lower frequency of the band-pass applied before scoring
+        h_freq: higher frequency of the band-pass applied before scoring
+        threshold: z-score above which a component is marked bad
+
+    Returns:
+        list of indices of bad components, scores (array, or list of arrays
+        for more than one channel)
+    """
+    scores = []
+    bad_idx = []
+    for ch_name in ch_names:
+        scores.append(ica.score_sources(raw, target=ch_name, score_func=_pearson_rows,
+                                        l_freq=l_freq, h_freq=h_freq))
+        bad_idx.append(_find_outliers(scores[-1], threshold=threshold))
+
+    # remove duplicates but keep the order by score, across all channels
+    bad_scores = np.concatenate([s[idx] for s, idx in zip(scores, bad_idx)])
+    ordered = np.concatenate(bad_idx)[np.abs(bad_scores).argsort()[::-1]]
+    indices = []
+    for i in ordered.tolist():
+        if i not in indices:
+            indices.append(i)
+
+    return indices, scores[0] if len(scores) == 1 else scores
+
+
+@contextlib.contextmanager
+def _quiet_logs():
+    """Context in which MNE and pyprep only log errors. pyprep logs the bad channels
+    of every referencing iteration at INFO level (and pyprep.reference enables
+    INFO logging on import). Both levels are restored afterwards.
+    """
+    pyprep_log = logging.getLogger('pyprep')
+    level = pyprep_log.level
+    pyprep_log.setLevel(logging.ERROR)
+    try:
+        with mne.use_log_level('ERROR'):
+            yield
+    finally:
+        pyprep_log.setLevel(level)
+
+
+def _write_atomic(path, write):
+    """Writes a file through a temporary file in the same folder, which is then
+    renamed to path, so an interrupted write never leaves a truncated file behind
+
+    Args:
+        path: str with path of the file to write
+        write: function taking the open binary file object and writing the content
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        # mkstemp creates the file readable by its owner only, give it
+        # the permissions of a normally created file instead
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp, 0o666 & ~umask)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def _load_cached(file_name):
+    """Loads an EDF file through a NumPy cache kept next to it
+    ("<file>.raw.npy" with the samples and "<file>.info.pkl" with the header).
+    The first call reads the EDF and writes the cache, later calls load the 
+    cached samples with np.load instead of parsing and decoding the EDF again;
+    the data is loaded into memory either way, with the same float64 values.
+    The cache is rebuilt when the EDF file is newer than any of the two cache files.
+
+    Args:
+        file_name: str with path to EDF file
+
+    Returns:
+        MNE Raw object
+    """
+    cache = file_name + '.raw.npy'
+    info_cache = file_name + '.info.pkl'
+
+    if (not os.path.exists(cache) or not os.path.exists(info_cache)
+            or min(os.path.getmtime(cache), os.path.getmtime(info_cache)) < os.path.getmtime(file_name)):
+        raw = mne.io.read_raw_edf(file_name, preload=True, verbose='ERROR')
+        _write_atomic(cache, lambda f: np.save(f, raw._data))
+        _write_atomic(info_cache, lambda f: pickle.dump((raw.info, raw.annotations, 
+                                                         raw._raw_extras, raw._orig_units), f))
+        return raw
+
+    data = np.load(cache)
+    with open(info_cache, 'rb') as f:
+        info, annotations, raw_extras, orig_units = pickle.load(f)
+
+    raw = mne.io.RawArray(data, info, verbose='ERROR')
+    raw.set_annotations(annotations)
+    # header fields of the original EDF, write_mne_edf needs them
+    raw._raw_extras = raw_extras
+    raw._orig_units = orig_units
+    return raw
+
+
 class Pipeline:
     """The class' aim is preprocessing clean extracted segments of clinical 
     EEG recordings (in EDF format) and make them a suitable input for later analysis 
@@ -20,11 +258,11 @@ class Pipeline:
     Then the object returns a pre-processed EEG data in raw format
 
     Attributes:
-        rawResampled: contains the resampled EEG segment in raw format
-        rawFiltered: contains the filtered EEG segment in raw format
-        raw: MNE Raw EDF object
-        rawPrep: contains the EEG segment in raw format after marking bad channels(as per PREP)
-        rawIca: contains the EEG segment after ICA is performed on it for both EOG and ECG channels
+        raw: MNE Raw EDF object, loaded into memory; every step modifies it in place,
+             so after applyPipeline it contains the pre-processed EEG segment
+        n_jobs: number of jobs (or 'cuda') used for resampling and filtering
+        ica_method: ICA algorithm used by ica(), 'fastica' or 'picard'
+        verbose: boolean value to denote if the progress of each step is printed
             
     Methods:
         resample: resamples the EEG segment to the target_frequency
@@ -38,105 +276,148 @@ class Pipeline:
 
     """
 
-    def __init__(self, file_name, view_plots = False) -> None:
+    def __init__(self, file_name = None, view_plots = False, raw = None, n_jobs = None, cache = False,
+                 ica_method = 'fastica', verbose = False) -> None:
         """
         Args:
             file_name: str with path to EDF file
             view_plots: boolean value to denote if we want to view plots. 
                         Turned off while processing multiple files. 
+            raw: MNE Raw object, used instead of reading file_name; loaded into memory if it isn't
+                 (e.g. a segment yielded by edf_extraction.slice_edfs_iter)
+            n_jobs: number of jobs (or 'cuda') used for resampling and filtering;
+                    by default the GPU if available, else all CPU cores
+            cache: boolean value to denote if file_name is read through a NumPy cache
+                   kept next to it, which makes repeated runs on the same files faster
+            ica_method: ICA algorithm, 'fastica' or 'picard' (needs python-picard installed)
+            verbose: boolean value to denote if the progress of each step is printed;
+                     otherwise MNE and pyprep only log errors during applyPipeline, which keeps batch runs quiet
         """
-        self.raw = mne.io.read_raw_edf(file_name)
-        if 'EKG1' in self.raw.ch_names and 'EOG1' in self.raw.ch_names:
-            self.raw.set_channel_types({'EOG1': 'eog', 'EOG2': 'eog', 'EKG1': 'ecg', 'EKG2': 'ecg'})
-        elif 'ECG1' in self.raw.ch_names and 'EOG1' in self.raw.ch_names:
-            self.raw.set_channel_types({'EOG1': 'eog', 'EOG2': 'eog', 'ECG1': 'ecg', 'ECG2': 'ecg'})
-        
-        self.rawResampled = None
-        self.rawFiltered = None
-        self.rawPrep = None
-        self.rawIca = None
-
-        print("Created raw object")
+        self.verbose = verbose
+        self.n_jobs = _default_n_jobs() if n_jobs is None else n_jobs
+        self.ica_method = ica_method
+        if raw is not None:
+            # every step works on the data in memory
+            self.raw = raw.load_data()
+        elif cache:
+            self.raw = _load_cached(file_name)
+        else:
+            self.raw = mne.io.read_raw_edf(file_name, preload=True, verbose='ERROR')
+        ch = frozenset(self.raw.ch_names)
+        if {'EKG1', 'EOG1'} <= ch:
+            ecg_chs = ('EKG1', 'EKG2')
+        elif {'ECG1', 'EOG1'} <= ch:
+            ecg_chs = ('ECG1', 'ECG2')
+        else:
+            ecg_chs = None
+        if ecg_chs is not None:
+            self.raw.set_channel_types({'EOG1': 'eog', 'EOG2': 'eog', ecg_chs[0]: 'ecg', ecg_chs[1]: 'ecg'})
+
+        if self.verbose:
+            print("Created raw object")
         if (view_plots):
             self.showplot(self.raw)
         
         
-    def resample(self, target_frequency, view_plots) -> None:
+    def resample(self, target_frequency, view_plots, n_jobs = None) -> None:
         """Resamples the given EEG segement to the target frequency
 
         Args:
             target_frequency: interger indicating the final EEG frequency after resampling
             view_plots: boolean value to denote if we want to view plots
+            n_jobs: number of jobs (or 'cuda') for resampling, self.n_jobs by default
 
         Returns:
             None
         """
-        self.rawResampled = self.raw
-        self.rawResampled.resample(target_frequency)
+        n_jobs = self.n_jobs if n_jobs is None else n_jobs
+        self.raw.resample(target_frequency, npad='auto', n_jobs=n_jobs)
 
-        print("Resampled raw object")
+        if self.verbose:
+            print("Resampled raw object")
         if (view_plots):
-            self.showplot(self.rawResampled)
+            self.showplot(self.raw)
 
 
-    def filter(self, view_plots) -> None:
+    def filter(self, view_plots, n_jobs = None) -> None:
         """Filters the given EEG segement between 5 Hz and 100 Hz
 
         Args:
             view_plots: boolean value to denote if we want to view plots
+            n_jobs: number of jobs (or 'cuda') for FIR filtering, self.n_jobs by default
 
         Returns:
             None
         """
-        self.rawFiltered = self.rawResampled
-        channels = list(set(self.rawFiltered.ch_names) - set(["EOG1", "EOG2"]))
-
-        self.rawFiltered.filter(l_freq=1, h_freq=100, picks=channels)
-        self.rawFiltered.filter(l_freq=1, h_freq=5, picks=["EOG1", "EOG2"])
-
-        print("Filtered raw object")
+        exclude = {"EOG1", "EOG2"}
+        channels = [c for c in self.raw.ch_names if c not in exclude]
+
+        # MNE filters only the picked channels, so the two passes together
+        # still touch every channel once
+        n_jobs = self.n_jobs if n_jobs is None else n_jobs
+        self.raw.filter(l_freq=1, h_freq=100, picks=channels, n_jobs=n_jobs,
+                        method='fir', phase='zero', fir_design='firwin')
+        self.raw.filter(l_freq=1, h_freq=5, picks=["EOG1", "EOG2"], n_jobs=n_jobs,
+                        method='fir', phase='zero', fir_design='firwin')
+
+        if self.verbose:
+            print("Filtered raw object")
         if (view_plots):
-            self.showplot(self.rawFiltered)
+            self.showplot(self.raw)
 
-    def prep(self, view_plots) -> None:
+    def prep(self, view_plots, n_jobs = None) -> None:
         """Applies the PREP pipeline to the EEG segment to mark the bad channels
 
         Args:
             view_plots: boolean value to denote if we want to view plots
+            n_jobs: number of jobs for the line noise removal, self.n_jobs by default
 
         Returns:
             None
         """
-        self.rawPrep = self.rawFiltered
-        mne.datasets.eegbci.standardize(self.rawPrep)
+        mne.datasets.eegbci.standardize(self.raw)
 
         # Add a montage to the data
         montage_kind = "standard_1005"
-        montage = mne.channels.make_standard_montage(montage_kind)
-        self.rawPrep.set_montage(montage, on_missing='ignore')
+        montage = _standard_montage(montage_kind)
+        self.raw.set_montage(montage, on_missing='ignore')
 
         # Extract some info
-        sample_rate = self.rawPrep.info["sfreq"]
+        sample_rate = self.raw.info["sfreq"]
 
         prep_params = {
             "ref_chs": "eeg",
             "reref_chs": "eeg",
-            "line_freqs": np.arange(60, sample_rate / 2, 60),
+            "line_freqs": _line_freqs(sample_rate),
         }
 
-        prep = PrepPipeline(self.rawPrep, prep_params, montage)
-        prep.fit()
-
-        print("Bad channels: {}".format(prep.interpolated_channels))
-        print("Bad channels original: {}".format(prep.noisy_channels_original["bad_all"]))
-        print("Bad channels after interpolation: {}".format(prep.still_noisy_channels))
-        print("SUCCESS Step 4: Applied Prep Pipeline to remove bad channels")
-
-        self.rawPrep = prep.raw.copy()
-        print("Applied ICA on raw object")
+        # PREP's own line noise filter settings, plus the number of jobs;
+        # spectrum fitting runs on the CPU only
+        n_jobs = self.n_jobs if n_jobs is None else n_jobs
+        filter_kwargs = dict(method="spectrum_fit", mt_bandwidth=2, p_value=0.01, filter_length="10s",
+                             n_jobs=1 if n_jobs == 'cuda' else n_jobs)
+
+        # a fixed random state makes RANSAC pick the same channel subsets for
+        # every segment, so their interpolation matrices are taken from the cache;
+        # it also makes the detected bad channels the same on every run
+        prep = PrepPipeline(self.raw, prep_params, montage, random_state=97,
+                            filter_kwargs=filter_kwargs)
+        with _cached_ransac():
+            prep.fit()
+
+        if self.verbose:
+            print("Bad channels: {}".format(prep.interpolated_channels))
+            print("Bad channels original: {}".format(prep.noisy_channels_original["bad_all"]))
+            print("Bad channels after interpolation: {}".format(prep.still_noisy_channels))
+            print("SUCCESS Step 4: Applied Prep Pipeline to remove bad channels")
+
+        # prep is not used after this, so its Raw is taken over without a copy
+        self.raw = prep.raw
+        if self.verbose:
+            print("Applied ICA on raw object")
 
         if (view_plots):
-            self.showplot(self.rawPrep)
+            self.showplot(self.raw)
 
 
     def ica(self, components, applyICA, view_plots) -> None:
@@ -150,38 +431,51 @@ class Pipeline:
         Returns:
             None
         """
-        self.rawIca = self.rawPrep
-        self.rawIca.filter(l_freq=1, h_freq=None)
-        raw_copy = self.rawIca.copy()
-        ica = ICA(n_components=len(raw_copy.pick_types(eeg=True, exclude='bads', 
-                selection=None, verbose=None).ch_names), max_iter='auto', random_state=97)
-        ica.fit(self.rawIca)
+        # the data is already high-passed at 1 Hz in filter(), and the number
+        # of good EEG channels is read from the channel info, without copying the data
+        n_eeg = len(mne.pick_types(self.raw.info, eeg=True, exclude='bads'))
+
+        # at most 200 iterations instead of the 1000 of max_iter='auto';
+        # tol=1e-4 and the parallel algorithm are FastICA's defaults, spelled out here,
+        # picard keeps its own (tighter) default tolerance
+        if self.ica_method == 'fastica':
+            fit_params = dict(tol=1e-4, algorithm='parallel')
+        else:
+            fit_params = None
+        ica = ICA(n_components=n_eeg, max_iter=200, method=self.ica_method,
+                  fit_params=fit_params, random_state=97)
+
+        ica.fit(self.raw)
         
-        if "EOG1" in self.rawIca.ch_names or "EOG2" in self.rawIca.ch_names:
-            eog_indices, eog_scores = ica.find_bads_eog(self.rawIca)
+        if "EOG1" in self.raw.ch_names or "EOG2" in self.raw.ch_names:
+            eog_chs = [c for c in ["EOG1", "EOG2"] if c in self.raw.ch_names]
+            eog_indices, eog_scores = _find_bads_corr(ica, self.raw, eog_chs, l_freq=1, h_freq=10)
             ica.exclude = eog_indices
 
             if (view_plots) and eog_indices != []:
                 ica.plot_scores(eog_scores)
             
                 # plot diagnostics
-                ica.plot_properties(self.rawIca, picks=eog_indices)
+                ica.plot_properties(self.raw, picks=eog_indices)
 
                 # plot ICs applied to raw data, with EOG matches highlighted
-                ica.plot_sources(self.rawIca, show_scrollbars=False)
+                ica.plot_sources(self.raw, show_scrollbars=False)
 
                 print("Removed EOG Artifacts using ICA")
-                self.showplot(self.rawIca)
+                self.showplot(self.raw)
 
             if applyICA:
-                ica.apply(self.rawIca)
-                self.showplot(self.rawIca)
+                ica.apply(self.raw)
+                if (view_plots):
+                    self.showplot(self.raw)
 
-        if "EKG1" in self.rawIca.ch_names or "EKG2" in self.rawIca.ch_names:
+        if "EKG1" in self.raw.ch_names or "EKG2" in self.raw.ch_names:
             ica.exclude = []
             # find which ICs match the ECG pattern
-            ecg_indices, ecg_scores = ica.find_bads_ecg(self.rawIca, method='correlation',
-                                                        threshold='auto')
+            # same as ica.find_bads_ecg(method='correlation', threshold='auto'),
+            # which scores against the first ECG channel
+            ecg_ch = "EKG1" if "EKG1" in self.raw.ch_names else "EKG2"
+            ecg_indices, ecg_scores = _find_bads_corr(ica, self.raw, [ecg_ch], l_freq=8, h_freq=16)
             ica.exclude = ecg_indices
 
             if (view_plots) and ecg_indices != []:
@@ -189,30 +483,36 @@ class Pipeline:
                 ica.plot_scores(ecg_scores)
 
                 # plot ICs applied to raw data, with ECG matches highlighted
-                ica.plot_sources(self.rawIca, show_scrollbars=False)
+                ica.plot_sources(self.raw, show_scrollbars=False)
                 print("Removed ECG Artifacts using ICA")
 
-                # ica.apply(self.rawIca)                
-                self.showplot(self.rawIca)
+                # ica.apply(self.raw)                
+                self.showplot(self.raw)
                 
             if applyICA:
-                ica.apply(self.rawIca)
-                self.showplot(self.rawIca)
+                ica.apply(self.raw)
+                if (view_plots):
+                    self.showplot(self.raw)
 
 
 
-    def showplot(self, raw, psd = True, time_series = True) -> None:
+    def showplot(self, raw, psd = True, time_series = True, picks = None) -> None:
         """Shows the time domain plot of the given EEG segment for 30 seconds
 
         Args:
             raw: the EEG segment to be plotted 
+            picks: indices of the channels to be plotted, by default
+                   the first 32 good EEG channels (the first 32 channels if there are none)
 
         Returns:
             None
         """
         if time_series:
-            artifact_picks = mne.pick_channels(raw.ch_names, include=raw.ch_names)
-            raw.plot(order=artifact_picks, n_channels=len(artifact_picks),
+            if picks is None:
+                picks = mne.pick_types(raw.info, eeg=True, exclude='bads')[:32]
+                if len(picks) == 0:
+                    picks = np.arange(min(32, len(raw.ch_names)))
+            raw.plot(order=picks, n_channels=len(picks),
                     show_scrollbars=False, duration=5, start=0, block=True, 
                     scalings='auto')
         
@@ -233,15 +533,17 @@ class Pipeline:
         Returns:
             None
         """
-        self.resample(target_frequency, view_plots)
-        self.filter(view_plots)
-        self.prep(view_plots)
-        self.ica(components, applyICA, view_plots) 
+        quiet = contextlib.nullcontext() if self.verbose else _quiet_logs()
+        with quiet:
+            self.resample(target_frequency, view_plots)
+            self.filter(view_plots)
+            self.prep(view_plots)
+            self.ica(components, applyICA, view_plots) 
 
     def getRaw(self):
         """
         Returns:
             Raw EDF object (preprocessed)
         """
-        return self.rawIca
+        return self.raw
         